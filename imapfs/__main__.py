@@ -26,6 +26,25 @@ fs.parser.add_option(
   help="Mailbox name the files are stored in [default: %default]",
 )
 
+fs.parser.add_option(
+  mountopt="stat_cache_max_size",
+  metavar="COUNT",
+  default=fs.stat_cache_max_size,
+  help="Maximum number of files and directories kept open [default: %default]",
+)
+fs.parser.add_option(
+  mountopt="uid_cache_max_size",
+  metavar="COUNT",
+  default=fs.uid_cache_max_size,
+  help="Maximum number of cached message UIDs [default: %default]",
+)
+fs.parser.add_option(
+  mountopt="metadata_cache_ttl",
+  metavar="SECONDS",
+  default=fs.metadata_cache_ttl,
+  help="Seconds the UIDs cached by the previous mount are trusted, 0 to disable [default: %default]",
+)
+
 fs.parse(values=fs, errex=1)
 ret = fs.main()
 exit(ret)
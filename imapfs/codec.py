@@ -0,0 +1,94 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import functools
+import logging
+
+try:
+  # Optional SIMD accelerated implementation
+  import pybase64
+except ImportError:
+  pybase64 = None  # type: ignore[assignment]
+
+if pybase64 is not None:
+  _b64encode = pybase64.b64encode
+  _b64decode = pybase64.b64decode
+  logging.debug("Using pybase64 %s", pybase64.get_version())
+else:
+  _b64encode = functools.partial(binascii.b2a_base64, newline=False)
+  _b64decode = binascii.a2b_base64
+
+try:
+  # Optional compression of message data
+  import zstandard
+except ImportError:
+  zstandard = None  # type: ignore[assignment]
+
+if zstandard is not None:
+  _compressor = zstandard.ZstdCompressor(level=3)
+  _decompressor = zstandard.ZstdDecompressor()
+
+
+# Length of an encoded line, as required by RFC 2045
+LINE_LENGTH = 76
+
+
+class CompressionUnavailableError(IOError):
+  """Raised when reading a compressed message without the zstandard module
+  """
+
+
+def encode_message(data: bytes) -> bytes:
+  """Encode data as base64 text in lines of LINE_LENGTH characters, each ended by CRLF
+  """
+  if not data:
+    return b""
+  text = _b64encode(data)
+  lines = [text[i:i + LINE_LENGTH] for i in range(0, len(text), LINE_LENGTH)]
+  lines.append(b"")
+  return b"\r\n".join(lines)
+
+
+def decode_message(text: bytes) -> bytes:
+  """Decode base64 text, ignoring line breaks
+  """
+  return _b64decode(text)
+
+
+def decode_partial(text: bytes) -> bytes:
+  """Decode the start of a base64 text cut at an arbitrary point
+  """
+  text = b"".join(text.split())
+  return _b64decode(text[:len(text) - len(text) % 4])
+
+
+def compress_message(data: bytes) -> bytes | None:
+  """Compress data with zstd
+  Returns None if the zstandard module is not installed
+  """
+  if zstandard is None:
+    return None
+  return _compressor.compress(data)
+
+
+def decompress_message(data: bytes) -> bytes:
+  """Decompress data compressed by compress_message
+  Raises CompressionUnavailableError if the zstandard module is not installed
+  """
+  if zstandard is None:
+    raise CompressionUnavailableError("zstandard is required to read compressed messages")
+  return _decompressor.decompress(data)
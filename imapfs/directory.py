@@ -19,6 +19,7 @@ from typing import Self
 
 from imapfs import message
 from imapfs.imapconnection import IMAPConnection
+from imapfs.keys import format_key, parse_key
 
 
 class Directory:
@@ -26,20 +27,32 @@ class Directory:
   Contains a list of file names
   """
 
-  def __init__(self, msg: message.Message, ctime: float, mtime: float, children: dict[str, str]):
+  def __init__(self, msg: message.Message, ctime: float, mtime: float, children: dict[bytes, str] | None):
     self.message = msg
+    # Listings are text, they compress well
+    self.message.compress = True
     self.ctime = ctime
     self.mtime = mtime
-    self.children = children
+    self._children = children
     self.dirty = False
 
-  def add_child(self, key: str, name: str) -> None:
+  @property
+  def children(self) -> dict[bytes, str]:
+    """Child names by key
+    Read from the message on first access, if it was not loaded yet
+    """
+    if self._children is None:
+      self.message.seek(0)
+      self._children = self.parse_children(bytes(self.message.read()).split(b"\r\n")[2:])
+    return self._children
+
+  def add_child(self, key: bytes, name: str) -> None:
     """Add a child to this directory
     """
     self.children[key] = name
     self.dirty = True
 
-  def remove_child(self, key: str) -> None:
+  def remove_child(self, key: bytes) -> None:
     """Remove a child by key from this dir
     """
     if key not in self.children:
@@ -47,7 +60,7 @@ class Directory:
     self.children.pop(key)
     self.dirty = True
 
-  def get_child_by_name(self, name: str) -> str | None:
+  def get_child_by_name(self, name: str) -> bytes | None:
     """Get a child's key by its name
     """
     for child_key, child_name in self.children.items():
@@ -55,18 +68,24 @@ class Directory:
         return child_key
     return None
 
-  def flush(self) -> None:
-    """Writes the changes to the server
+  def update_message(self) -> None:
+    """Writes the changes to the message, without flushing it
     """
     if self.dirty:
+      children = self.children  # before clearing the message it is read from
       self.mtime = time.time()
       self.message.truncate(0)  # clear
       self.message.write(b"d\r\n%d\t%d\r\n" % (self.ctime, self.mtime))
-      for child_key, child_name in self.children.items():
-        self.message.write(b"%s\t%s\r\n" % (child_key.encode(), child_name.encode()))
-      self.message.flush()
+      for child_key, child_name in children.items():
+        self.message.write(b"%s\t%s\r\n" % (format_key(child_key).encode(), child_name.encode()))
       self.dirty = False
 
+  def flush(self) -> None:
+    """Writes the changes to the server
+    """
+    self.update_message()
+    self.message.flush()
+
   def close(self) -> None:
     """Close
     Calls flush
@@ -86,18 +105,27 @@ class Directory:
   @classmethod
   def from_message(cls, msg: message.Message) -> Self:
     """Create a directory object from a message
+    Children are parsed on first access if the message is not loaded yet
     """
-    data = bytes(msg.read()).decode()
+    # Only the data held, at least the header line
+    data = bytes(msg.read(msg.size))
 
-    lines = data.split("\r\n")
-    info = lines[1].split("\t")
+    lines = data.split(b"\r\n")
+    info = lines[1].split(b"\t")
 
-    children = {}
-    for line in lines[2:]:
-      if not line:
-        continue
-      line_info = line.split("\t")
-      children[line_info[0]] = line_info[1]
+    children = cls.parse_children(lines[2:]) if msg.loaded else None
 
     d = cls(msg, int(info[0]), int(info[1]), children)
     return d
+
+  @staticmethod
+  def parse_children(lines: list[bytes]) -> dict[bytes, str]:
+    """Parse the child lines of a directory message
+    """
+    children = {}
+    for line in lines:
+      if not line:
+        continue
+      line_info = line.decode().split("\t")
+      children[parse_key(line_info[0])] = line_info[1]
+    return children
@@ -18,9 +18,9 @@ import logging
 import os
 import time
 from typing import Self
-import uuid
 
 from imapfs import message
+from imapfs.keys import format_key, new_key, parse_key
 
 
 FS_BLOCK_SIZE = 262144
@@ -29,25 +29,34 @@ FS_BLOCK_SIZE = 262144
 class File:
   """Represents a file
   """
-  def __init__(self, msg, ctime: float, mtime: float, size: int, blocks: dict[int, str]):
+  def __init__(self, msg, ctime: float, mtime: float, size: int, blocks: dict[int, bytes] | None):
     self.message = msg
     self.ctime = ctime
     self.mtime = mtime
     self.size = size
-    self.blocks = blocks
+    self._blocks = blocks
     self.dirty = False
 
     self.pos = 0
 
     self.open_messages: dict[int, message.Message] = {}
 
+  @property
+  def blocks(self) -> dict[int, bytes]:
+    """Block keys by block id
+    Read from the message on first access, if it was not loaded yet
+    """
+    if self._blocks is None:
+      self.message.seek(0)
+      self._blocks = self.parse_blocks(bytes(self.message.read()).split(b"\r\n")[2:])
+    return self._blocks
+
   def create_block(self, block_id: int) -> message.Message:
     """Create a block
     """
-    name = str(uuid.uuid4())
-    block = message.Message(self.message.conn, name, b"")
+    block = message.Message(self.message.conn, new_key(), b"")
     block.dirty = True
-    self.blocks[block_id] = block.name
+    self.blocks[block_id] = block.key
     self.open_messages[block_id] = block
     self.dirty = True
     return block
@@ -101,7 +110,7 @@ class File:
 
     # Close and delete truncated blocks
     end_block = self.size // FS_BLOCK_SIZE
-    for block_id in self.blocks:
+    for block_id in list(self.blocks):
       if block_id > end_block:
         self.delete_block(block_id)
         # We leave the entire last block intact, even if it got trimmed a little
@@ -117,7 +126,8 @@ class File:
     elif whence == os.SEEK_CUR:
       new_pos = old_pos + offset
     elif whence == os.SEEK_END:
-      new_pos = self.size - offset
+      new_pos = self.size + offset
+    assert new_pos >= 0
 
     # Get block we are moving from and to
     old_block_id = old_pos // FS_BLOCK_SIZE
@@ -142,7 +152,8 @@ class File:
     start_block_id = self.pos // FS_BLOCK_SIZE
     end_block_id = (self.pos + size) // FS_BLOCK_SIZE + 1
 
-    buf = bytearray()
+    parts = []
+    read_total = 0
 
     # For each block containing data we need
     for i in range(start_block_id, end_block_id):
@@ -152,24 +163,28 @@ class File:
       read_size = FS_BLOCK_SIZE - current_block_offset
 
       # Read only as much as we need
-      if len(buf) + read_size > size:
-        read_size = size - len(buf)
+      if read_total + read_size > size:
+        read_size = size - read_total
 
       # Open block, seek to position, read
       block = self.open_block(i)
       block.seek(current_block_offset)
 
-      buf += block.read(read_size)
+      parts.append(block.read(read_size))
+      read_total += read_size
 
       # Update seek position.
       self.seek(read_size, os.SEEK_CUR)
 
-    return buf
+    # Single copy of the block data
+    return b"".join(parts)
 
   def write(self, buf: bytes):
     """Write data to the file
     """
-    size = len(buf)
+    # Slices of a memoryview do not copy
+    view = memoryview(buf)
+    size = len(view)
     # Increase size if we need to
     if self.pos + size > self.size:
       self.truncate(self.pos + size)
@@ -193,7 +208,7 @@ class File:
       # Open, seek, write.
       block = self.open_block(i)
       block.seek(current_block_offset)
-      block.write(buf[write_offset:write_offset + write_size])
+      block.write(view[write_offset:write_offset + write_size])
 
       write_offset += write_size
 
@@ -203,19 +218,25 @@ class File:
 
     self.dirty = True
 
-  def flush(self):
-    """Flush changes to this file
+  def update_message(self):
+    """Write changes to this file's message, without flushing it
     """
     if self.dirty:
+      blocks = self.blocks  # before clearing the message it is read from
       self.mtime = time.time()
       self.message.truncate(0)
       self.message.write(b"f\r\n%d\t%d\t%d\r\n" % (self.ctime, self.mtime, self.size))
-      for block_id, block_key in self.blocks.items():
-        self.message.write(b"%d\t%s\r\n" % (block_id, block_key.encode()))
+      for block_id, block_key in blocks.items():
+        self.message.write(b"%d\t%s\r\n" % (block_id, format_key(block_key).encode()))
 
-      self.message.flush()
       self.dirty = False
 
+  def flush(self):
+    """Flush changes to this file
+    """
+    self.update_message()
+    self.message.flush()
+
   def close_blocks(self):
     """Closes all open blocks
     """
@@ -242,7 +263,7 @@ class File:
       message.Message.unlink(self.message.conn, block_key)
 
     # Unlink own block
-    message.Message.unlink(self.message.conn, self.message.name)
+    message.Message.unlink(self.message.conn, self.message.key)
 
   @classmethod
   def create(cls, conn) -> Self:
@@ -256,19 +277,29 @@ class File:
   @classmethod
   def from_message(cls, msg: message.Message) -> Self:
     """Create a file object from a message
+    Blocks are parsed on first access if the message is not loaded yet
     """
-    data = bytes(msg.read())
+    # Only the data held, at least the header line
+    data = bytes(msg.read(msg.size))
 
     lines = data.split(b"\r\n")
     info = lines[1].split(b"\t")
 
+    blocks = cls.parse_blocks(lines[2:]) if msg.loaded else None
+
+    f = cls(msg, int(info[0]), int(info[1]), int(info[2]), blocks)
+    return f
+
+  @staticmethod
+  def parse_blocks(lines: list[bytes]) -> dict[int, bytes]:
+    """Parse the block lines of a file message
+    """
     blocks = {}
 
-    for line in lines[2:]:
+    for line in lines:
       if not line:
         continue
       line_info = line.split(b"\t")
-      blocks[int(line_info[0])] = line_info[1].decode()
+      blocks[int(line_info[0])] = parse_key(line_info[1])
 
-    f = cls(msg, int(info[0]), int(info[1]), int(info[2]), blocks)
-    return f
+    return blocks
@@ -16,16 +16,36 @@
 
 import logging
 import stat
+import time
 import traceback
-import uuid
 from collections.abc import Generator
 
 import fuse
 
-from imapfs import directory, file, imapconnection, message
+from imapfs import codec, directory, file, imapconnection, message
+from imapfs.lrucache import LRUCache
 
 
-ROOT = str(uuid.UUID(int=0))
+# Formats as the nil UUID, the subject of the root directory
+ROOT = bytes(16)
+
+# Default maximum number of nodes kept open
+NODE_CACHE_SIZE = 4096
+
+# Seconds during which the attributes listed by readdir are trusted
+TYPE_CACHE_TTL = 60
+
+# Maximum number of paths remembered with the node they lead to
+PATH_CACHE_SIZE = 256
+
+# Seconds during which a path that was not found is not looked up again
+NEGATIVE_CACHE_TTL = 1
+
+# Number of bytes fetched to read the attributes of a node
+NODE_HEADER_SIZE = 64
+
+# Seconds changes to nodes are held back, to be flushed in one batch
+FLUSH_DELAY = 0.5
 
 fuse.fuse_python_api = (0, 2)
 
@@ -34,13 +54,38 @@ FileOrDir = file.File | directory.Directory
 Errno = int | None
 
 
+def parse_node_header(data: bytes) -> tuple[str, int] | None:
+  """Parse the type code and size from the start of a node message
+  Returns None if data is too short
+  """
+  lines = data.split(b"\r\n")
+  if len(lines) < 3:
+    return None
+
+  info = lines[1].split(b"\t")
+  if lines[0] == b"f" and len(info) >= 3:
+    return "f", int(info[2])
+  elif lines[0] == b"d":
+    return "d", 0
+  return None
+
+
 class IMAPFS(fuse.Fuse):
   """FUSE object for imapfs
   """
 
   def __init__(self, *args, **kwargs):
     fuse.Fuse.__init__(self, *args, **kwargs)
-    self.open_nodes: dict[str, FileOrDir] = {}
+    self.open_nodes: LRUCache[bytes, FileOrDir] = LRUCache(NODE_CACHE_SIZE, self.evict_node)
+    # Type code, size and expiry time of nodes that are not open
+    self.type_cache: LRUCache[bytes, tuple[str, int, float]] = LRUCache(NODE_CACHE_SIZE)
+    # Open nodes found by path, forgotten when they close or paths may lead elsewhere
+    self.path_cache: LRUCache[str, FileOrDir] = LRUCache(PATH_CACHE_SIZE)
+    # Expiry time of paths that were not found
+    self.neg_cache: LRUCache[str, float] = LRUCache(NODE_CACHE_SIZE)
+    # Nodes with changes waiting for flush_dirty
+    self.dirty_nodes: set[FileOrDir] = set()
+    self.dirty_since = 0.0
 
     self.key = ""
     self.rounds = 10000
@@ -49,12 +94,19 @@ class IMAPFS(fuse.Fuse):
     self.user = ""
     self.password = ""
     self.mailbox = ""
+    self.stat_cache_max_size = NODE_CACHE_SIZE
+    self.uid_cache_max_size = imapconnection.UID_CACHE_SIZE
+    self.metadata_cache_ttl = imapconnection.METADATA_CACHE_TTL
 
   def main(self, args=None):
     # Set up imap
     """Sets up IMAP connection and encryption
     """
-    self.imap = imapconnection.IMAPConnection(self.host, int(self.port))
+    self.open_nodes.max_size = int(self.stat_cache_max_size)
+    self.type_cache.max_size = int(self.stat_cache_max_size)
+    self.imap = imapconnection.IMAPConnection(
+      self.host, int(self.port), int(self.uid_cache_max_size), float(self.metadata_cache_ttl)
+    )
     self.imap.login(self.user, self.password)
     self.imap.select(self.mailbox)
 
@@ -63,53 +115,160 @@ class IMAPFS(fuse.Fuse):
     if check is None:
       self.init_filesystem()
     elif not check:
-      raise Exception("Incorrect encryption key")
+      raise Exception("Cannot read the filesystem in mailbox %s" % self.mailbox)
 
     # Run
     fuse.Fuse.main(self, args)
 
-    # Close all open nodes
+    # Write pending changes, then close all open nodes
+    self.flush_dirty()
     for node in list(self.open_nodes.values()):
       self.close_node(node)
 
     # Stop
     self.imap.logout()
 
-  def open_node(self, name: str) -> FileOrDir | None:
+  def open_node(self, key: bytes) -> FileOrDir | None:
     """Opens a node (file or directory)
+    Raises CompressionUnavailableError if the node is compressed and zstandard is not installed
     """
 
     # Check cache
-    if name in self.open_nodes:
-      return self.open_nodes[name]
+    if key in self.open_nodes:
+      return self.open_nodes[key]
 
     try:
-      msg = message.Message.open(self.imap, name)
+      msg = message.Message.open_meta(self.imap, key)
       if not msg:
         return None
+    except codec.CompressionUnavailableError:
+      # The node exists, do not let callers take it for a missing one
+      raise
     except Exception:
       traceback.print_exc()
       return None
 
-    # Determine file or dir
-    type_code = chr(msg.data[0])
+    obj = self.node_from_message(msg)
+    self.type_cache.pop(key, None)
+    self.open_nodes[key] = obj
+    return obj
 
-    if type_code == 'f':
-      obj: FileOrDir = file.File.from_message(msg)
-    elif type_code == 'd':
-      obj = directory.Directory.from_message(msg)
+  def node_from_message(self, msg: message.Message) -> FileOrDir:
+    """Create a node (file or directory) from an open message
+    """
+    # Determine file or dir
+    if msg.type_code == b"f":
+      return file.File.from_message(msg)
+    elif msg.type_code == b"d":
+      return directory.Directory.from_message(msg)
     else:
       raise Exception("Bad node")
 
-    self.open_nodes[name] = obj
-    return obj
+  def prefetch_children(self, node: directory.Directory, first_key: bytes) -> None:
+    """Open first_key along with other children of node that are not open yet
+    Uses batched lookups, so that walking the directory afterwards does not
+    cost one round trip per child
+    Only the free space of the open node cache is filled, so that nodes in use
+    are not evicted, and large compressed children are left to open_node
+    """
+    count = min(imapconnection.BATCH_SIZE, self.open_nodes.max_size - len(self.open_nodes))
+    if len(node.children) > self.open_nodes.max_size:
+      # The siblings would evict each other before being used
+      count = 1
+
+    keys = [first_key]
+    for child_key in node.children:
+      if len(keys) >= count:
+        break
+      if child_key != first_key and child_key not in self.open_nodes:
+        keys.append(child_key)
+
+    opened = message.Message.open_many(self.imap, keys, message.META_SIZE, skip_compressed=True)
+    for key, msg in opened.items():
+      try:
+        self.open_nodes[key] = self.node_from_message(msg)
+        self.type_cache.pop(key, None)
+      except Exception:
+        traceback.print_exc()
+
+  def get_cached_attributes(self, key: bytes) -> tuple[str, int] | None:
+    """Get the type code and size of a node that is not open from type_cache
+    Returns None if not cached or expired
+    """
+    if key in self.open_nodes or key not in self.type_cache:
+      return None
+
+    type_code, size, expiry = self.type_cache[key]
+    if expiry < time.time():
+      self.type_cache.pop(key)
+      return None
+    return type_code, size
+
+  def cache_children_attributes(self, node: directory.Directory) -> None:
+    """Fill type_cache for the children of node that are not open
+    Only the start of each child message is fetched, in batches
+    Compressed children cannot be decoded from their start, they are left
+    for getattr to open
+    """
+    keys = [key for key in node.children if not self.get_cached_attributes(key) and key not in self.open_nodes]
+    if not keys:
+      return
+
+    heads = self.imap.get_messages_by_subjects(keys, NODE_HEADER_SIZE, skip_compressed=True)
+
+    expiry = time.time() + TYPE_CACHE_TTL
+    for key, head in heads.items():
+      attributes = parse_node_header(head)
+      if attributes:
+        self.type_cache[key] = attributes + (expiry,)
 
   def close_node(self, node: FileOrDir) -> None:
     """Close an open node
     """
     node.close()
-    if node.message.name in self.open_nodes:
-      self.open_nodes.pop(node.message.name)
+    self.dirty_nodes.discard(node)
+    self.forget_paths(node)
+    if node.message.key in self.open_nodes:
+      self.open_nodes.pop(node.message.key)
+
+  def mark_dirty(self, *nodes: FileOrDir) -> None:
+    """Schedule nodes to be flushed with the next batch
+    The batch is flushed once it is older than FLUSH_DELAY
+    """
+    if not self.dirty_nodes:
+      self.dirty_since = time.time()
+    self.dirty_nodes.update(nodes)
+
+    if time.time() - self.dirty_since > FLUSH_DELAY:
+      self.flush_dirty()
+
+  def flush_dirty(self, *nodes: FileOrDir) -> None:
+    """Flush the given nodes, or all nodes scheduled by mark_dirty if none are given
+    Their messages are written in pipelined batches
+    """
+    if not nodes:
+      nodes = tuple(self.dirty_nodes)
+    self.dirty_nodes.difference_update(nodes)
+
+    for node in nodes:
+      node.update_message()
+    message.Message.flush_many(self.imap, [node.message for node in nodes])
+
+  def evict_node(self, key: bytes, node: FileOrDir) -> None:
+    """Close a node evicted from the open nodes
+    Writes any changes
+    """
+    logging.debug("Evicting node %s", key.hex())
+    node.close()
+    self.dirty_nodes.discard(node)
+    self.forget_paths(node)
+
+  def forget_paths(self, node: FileOrDir) -> None:
+    """Remove the paths leading to node from path_cache
+    Paths leading to other nodes stay valid, even through node
+    """
+    for path in [path for path, cached in self.path_cache.items() if cached is node]:
+      del self.path_cache[path]
 
   def check_filesystem(self) -> bool | None:
     """Check if there is a filesystem present
@@ -120,19 +279,24 @@ class IMAPFS(fuse.Fuse):
     """
     try:
       root = self.open_node(ROOT)
+    except codec.CompressionUnavailableError:
+      logging.error("The root directory is compressed, the zstandard module is required to mount it")
+      return False
     except Exception:
       traceback.print_exc()
       return False
 
     if root is None:
+      # open_node also gives up on a root message it cannot decode, which must not be replaced
+      if self.imap.get_uid_by_subject(ROOT) is not None:
+        return False
       return None
 
     if not isinstance(root, directory.Directory):
       return False
 
     # check if decrypted properly
-    data = bytes(root.message.data[0:3])
-    if data != b"d\r\n":
+    if root.message.header != b"d\r\n":
       return False
 
     return True
@@ -141,33 +305,53 @@ class IMAPFS(fuse.Fuse):
     """Create a filesystem
     """
     root = directory.Directory.create(self.imap)
-    root.message.name = ROOT
+    root.message.key = ROOT
     root.close()
 
   def get_node_by_path(self, path: str) -> FileOrDir | None:
     """Open the node specified by path
-    Walks through the directory tree to find the node
+    Paths that were not found are not looked up again for NEGATIVE_CACHE_TTL
     """
-    # handle root
-    if path == "/":
-      return self.open_node(ROOT)
+    if path in self.path_cache:
+      cached = self.path_cache[path]
+      if self.open_nodes.get(cached.message.key) is cached:
+        # Mark the node as used, like open_node does
+        self.open_nodes.move_to_end(cached.message.key)
+        return cached
+
+    expiry = self.neg_cache.get(path)
+    if expiry is not None:
+      if expiry > time.time():
+        return None
+      del self.neg_cache[path]
 
-    # split into directory parts
-    parts = path.split("/")
+    node = self.walk_path(path)
+    if node is None:
+      self.neg_cache[path] = time.time() + NEGATIVE_CACHE_TTL
+    else:
+      self.path_cache[path] = node
+    return node
+
+  def walk_path(self, path: str) -> FileOrDir | None:
+    """Open the node specified by path
+    Walks through the directory tree to find the node
+    """
+    # split into directory parts, without the blank entries from double slashes
+    parts = [part for part in path.split("/") if part]
     current_node = self.open_node(ROOT)
     for part in parts:
-      if not part:  # blank entry from double slashes
-        continue
-
       # Trying to get the child of a file?
       if not isinstance(current_node, directory.Directory):
-        break
+        return None
 
       # find children
       child_key = current_node.get_child_by_name(part)
       if not child_key:
         return None
 
+      if child_key not in self.open_nodes:
+        self.prefetch_children(current_node, child_key)
+
       # Open child, then set it to be searched
       child_node = self.open_node(child_key)
       if not child_node:
@@ -199,21 +383,33 @@ class IMAPFS(fuse.Fuse):
     return st
 
   def getattr(self, path: str) -> fuse.Stat | int:
-    node = self.get_node_by_path(path)
+    # Use the attributes listed by readdir if the node is not open
+    attributes = None
+    parent = self.get_node_by_path(self.get_path_parent(path))
+    if isinstance(parent, directory.Directory):
+      child_key = parent.get_child_by_name(self.get_path_filename(path))
+      if child_key:
+        attributes = self.get_cached_attributes(child_key)
 
-    if not node:
-      return -fuse.ENOENT
+    if attributes:
+      type_code, size = attributes
+    else:
+      node = self.get_node_by_path(path)
+      if not node:
+        return -fuse.ENOENT
+      type_code = "d" if isinstance(node, directory.Directory) else "f"
+      size = 0 if isinstance(node, directory.Directory) else node.size
 
     st = fuse.Stat()
 
-    if isinstance(node, directory.Directory):
+    if type_code == "d":
       st.st_mode = stat.S_IFDIR | 0o777
       st.st_nlink = 2
       st.st_size = 4096
     else:
       st.st_mode = stat.S_IFREG | 0o666
       st.st_nlink = 1
-      st.st_size = node.size
+      st.st_size = size
 
     return st
 
@@ -224,6 +420,9 @@ class IMAPFS(fuse.Fuse):
 
     logging.debug("Listing %s/", path)
 
+    # Callers usually stat every entry next
+    self.cache_children_attributes(node)
+
     yield fuse.Direntry(".")
     yield fuse.Direntry("..")
 
@@ -243,8 +442,11 @@ class IMAPFS(fuse.Fuse):
     logging.debug("Creating directory %s/", path)
 
     child = directory.Directory.create(self.imap)
-    self.open_nodes[child.message.name] = child
-    parent.add_child(child.message.name, self.get_path_filename(path))
+    self.neg_cache.pop(path, None)
+    # Add to the parent first: opening the child may evict and flush the parent
+    parent.add_child(child.message.key, self.get_path_filename(path))
+    self.open_nodes[child.message.key] = child
+    self.mark_dirty(parent, child)
 
   def rmdir(self, path: str) -> Errno:
     child = self.get_node_by_path(path)
@@ -265,9 +467,11 @@ class IMAPFS(fuse.Fuse):
 
     assert isinstance(parent, directory.Directory)
 
-    parent.remove_child(child.message.name)
+    parent.remove_child(child.message.key)
+    # close_node forgets the paths leading to child
     self.close_node(child)
-    message.Message.unlink(self.imap, child.message.name)
+    message.Message.unlink(self.imap, child.message.key)
+    self.mark_dirty(parent)
 
   def mknod(self, path: str, mode, dev) -> Errno:
     parent = self.get_node_by_path(self.get_path_parent(path))
@@ -282,8 +486,11 @@ class IMAPFS(fuse.Fuse):
     logging.debug("Creating file %s", path)
 
     node = file.File.create(self.imap)
-    self.open_nodes[node.message.name] = node
-    parent.add_child(node.message.name, self.get_path_filename(path))
+    self.neg_cache.pop(path, None)
+    # Add to the parent first: opening the node may evict and flush the parent
+    parent.add_child(node.message.key, self.get_path_filename(path))
+    self.open_nodes[node.message.key] = node
+    self.mark_dirty(parent, node)
 
   def rename(self, oldpath: str, newpath: str) -> Errno:
     # handle dir name
@@ -309,6 +516,7 @@ class IMAPFS(fuse.Fuse):
       assert child_key
       parent.children[child_key] = self.get_path_filename(newpath)
       parent.dirty = True
+      self.mark_dirty(parent)
     else:
       # Different parent
       old_node = self.get_node_by_path(oldpath)
@@ -329,8 +537,13 @@ class IMAPFS(fuse.Fuse):
       assert isinstance(new_parent, directory.Directory)
 
       # Remove old, add new
-      new_parent.add_child(old_node.message.name, self.get_path_filename(oldpath))
-      old_parent.remove_child(old_node.message.name)
+      new_parent.add_child(old_node.message.key, self.get_path_filename(oldpath))
+      old_parent.remove_child(old_node.message.key)
+      self.mark_dirty(new_parent, old_parent)
+
+    # Paths under newpath may exist after the move, those under oldpath no longer do
+    self.neg_cache.clear()
+    self.path_cache.clear()
 
   def utime(self, path: str, times) -> Errno:
     node = self.get_node_by_path(path)
@@ -339,6 +552,7 @@ class IMAPFS(fuse.Fuse):
 
     node.mtime = times[1]
     node.dirty = True
+    self.mark_dirty(node)
 
   def unlink(self, path: str) -> Errno:
     node = self.get_node_by_path(path)
@@ -352,9 +566,12 @@ class IMAPFS(fuse.Fuse):
     logging.debug("Removing %s", path)
     assert isinstance(parent, directory.Directory)
 
-    parent.remove_child(node.message.name)
+    parent.remove_child(node.message.key)
     node.delete()
-    self.open_nodes.pop(node.message.name)
+    self.dirty_nodes.discard(node)
+    self.path_cache.clear()
+    self.open_nodes.pop(node.message.key, None)
+    self.mark_dirty(parent)
 
   def truncate(self, path: str, size: int) -> Errno:
     node = self.get_node_by_path(path)
@@ -367,6 +584,7 @@ class IMAPFS(fuse.Fuse):
     logging.debug("Resizing %s to %d", path, size)
 
     node.truncate(size)
+    self.mark_dirty(node)
 
   def read(self, path: str, size: int, offset: int) -> bytes | Errno:
     node = self.get_node_by_path(path)
@@ -389,10 +607,8 @@ class IMAPFS(fuse.Fuse):
     if not isinstance(node, file.File):
       return -fuse.EISDIR
 
-    byte_buf = bytearray(buf)
-
     node.seek(offset)
-    node.write(byte_buf)
+    node.write(buf)
 
     logging.debug("Write %d-%d", offset, offset + len(buf))
 
@@ -408,7 +624,7 @@ class IMAPFS(fuse.Fuse):
 
     node.close_blocks()
 
-    node.flush()
+    self.flush_dirty(node)
 
   def releasedir(self, path: str) -> Errno:
     node = self.get_node_by_path(path)
@@ -418,7 +634,24 @@ class IMAPFS(fuse.Fuse):
     logging.debug("Closing %s/", path)
     assert isinstance(node, directory.Directory)
 
-    node.flush()
+    self.flush_dirty(node)
+
+  def fsync(self, path: str, datasync) -> Errno:
+    node = self.get_node_by_path(path)
+    if not node:
+      return -fuse.ENOENT
+
+    if isinstance(node, file.File):
+      node.close_blocks()
+
+    self.flush_dirty(node)
+
+  def fsyncdir(self, path: str, datasync) -> Errno:
+    node = self.get_node_by_path(path)
+    if not node:
+      return -fuse.ENOENT
+
+    self.flush_dirty(node)
 
   def chmod(self, path: str, mode) -> Errno:
     return 0
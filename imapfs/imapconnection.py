@@ -14,32 +14,201 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from base64 import b64encode, b64decode
-import email.mime.text
+import dbm
 import imaplib
+import logging
+import os
 import re
+import socket
 import time
+import urllib.parse
+
+from imapfs.codec import compress_message, decode_message, decode_partial, decompress_message, encode_message
+from imapfs.keys import format_key
+from imapfs.lrucache import LRUCache
+
+
+# Default maximum number of cached key to UID mappings
+UID_CACHE_SIZE = 20000
+
+# Default number of seconds the UIDs cached by a previous mount are trusted, 0 to disable
+METADATA_CACHE_TTL = 86400
+
+# Maximum number of messages looked up or fetched by a single command
+BATCH_SIZE = 64
+
+# Size of the buffer server responses are read through
+READ_BUFFER_SIZE = 262144
+
+_FETCH_START_RE = re.compile(rb"^\d+ \(")
+_FETCH_UID_RE = re.compile(rb"UID (\d+)", re.I)
+_FETCH_LITERAL_RE = re.compile(rb"(BODY\[[^\]]*\])(?:<\d+>)? \{\d+\}$", re.I)
+_SUBJECT_RE = re.compile(rb"^Subject: *(.*?)\s*$", re.I | re.M)
+_COMPRESSED_RE = re.compile(rb"^Content-Type: *application/zstd", re.I | re.M)
+_APPENDUID_RE = re.compile(rb"APPENDUID \d+ (\d+)", re.I)
+
+# Headers of a stored message, followed by its base64 encoded data
+_MESSAGE_HEADERS = (
+  b"Subject: %s\r\n"
+  b"MIME-Version: 1.0\r\n"
+  b"Content-Type: %s\r\n"
+  b"Content-Transfer-Encoding: base64\r\n"
+  b"\r\n"
+)
+
+
+def _parse_fetch(data: list) -> dict[str, dict[bytes, bytes]]:
+  """Parse the untagged responses of a UID FETCH
+  Returns the literal items (e.g. b"BODY[1]") of each message, keyed by UID
+  """
+  messages: dict[str, dict[bytes, bytes]] = {}
+  items: dict[bytes, bytes] = {}
+  for part in data:
+    if isinstance(part, tuple):
+      text, literal = part
+    elif part:
+      text, literal = part, None
+    else:
+      continue
+
+    if _FETCH_START_RE.match(text):
+      items = {}
+
+    if literal is not None:
+      match = _FETCH_LITERAL_RE.search(text)
+      if match:
+        items[match.group(1).upper()] = literal
+
+    # The UID may come before or after the literals of its message
+    match = _FETCH_UID_RE.search(text)
+    if match:
+      uid_items = messages.setdefault(match.group(1).decode(), items)
+      if uid_items is not items:
+        uid_items.update(items)
+        items = uid_items
+
+  return messages
+
+
+def _encoded_size(size: int) -> int:
+  """Length of the base64 text encoding size bytes
+  """
+  # 57 bytes are encoded per line of 76 characters and CRLF
+  return -(-size // 57) * 78
+
+
+def _body_item(size: int | None) -> str:
+  """FETCH item for the base64 text of a message, or for the text of its first size bytes
+  """
+  if size is None:
+    return "BODY[1]"
+  return "BODY.PEEK[1]<0.%d>" % _encoded_size(size)
+
+
+def _header_fields(items: dict[bytes, bytes]) -> bytes:
+  """Header lines fetched with BODY.PEEK[HEADER.FIELDS (...)]
+  """
+  return b"".join(value for name, value in items.items() if name.startswith(b"BODY[HEADER.FIELDS"))
+
+
+def _decode_body(items: dict[bytes, bytes], size: int | None) -> bytes | None:
+  """Decode the item requested by _body_item(size)
+  The Content-Type header field must have been fetched with it
+  Returns None for the start of a compressed message, which cannot be decoded
+  """
+  # BODY[1] is the base64 text alone, decoding it avoids parsing the message
+  data = items.get(b"BODY[1]", b"")
+  if _COMPRESSED_RE.search(_header_fields(items)):
+    # Less text than requested is the whole message
+    if size is not None and len(data) >= _encoded_size(size):
+      return None
+    return decompress_message(decode_message(data))
+  if size is None:
+    return decode_message(data)
+  return decode_partial(data)[:size]
+
+
+def _subject_criteria(subjects: list[str]) -> list[str]:
+  """SEARCH criteria for the messages with any of subjects, leaving out deleted ones
+  """
+  criteria = ["UNDELETED"] + ["OR"] * (len(subjects) - 1)
+  for subject in subjects:
+    criteria += ["SUBJECT", "\"%s\"" % subject]
+  return criteria
+
+
+def _newest_by_subject(fetched: dict[str, dict[bytes, bytes]], wanted: dict[str, bytes]) -> dict[bytes, str]:
+  """Find the UIDs of the keys in wanted, keyed by their formatted subject
+  The messages must have been fetched with their Subject header field
+  """
+  uids: dict[bytes, str] = {}
+  for uid, fetch_items in fetched.items():
+    match = _SUBJECT_RE.search(_header_fields(fetch_items))
+    if not match:
+      continue
+    key = wanted.get(match.group(1).decode())
+    # Keep the newest message, older ones are versions being replaced
+    if key is not None and (key not in uids or int(uid) > int(uids[key])):
+      uids[key] = uid
+  return uids
+
+
+class _IMAP4_SSL(imaplib.IMAP4_SSL):
+  """IMAP4_SSL issuing fewer, larger socket operations
+  """
+
+  def _create_socket(self, timeout):
+    sock = super()._create_socket(timeout)
+    # Pipelined commands are small writes, do not hold them back waiting for ACKs
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+  def open(self, host="", port=imaplib.IMAP4_SSL_PORT, timeout=None):
+    super().open(host, port, timeout)
+    # The default 8 KiB buffer needs many reads for a batch of FETCH responses
+    self.file.close()
+    self.file = self.sock.makefile("rb", buffering=READ_BUFFER_SIZE)
 
 
 class IMAPConnection:
   """Class that manages a connection to an IMAP server
+  Messages are identified by 16 byte keys, stored formatted as their subject
   """
 
-  def __init__(self, host: str, port: int):
+  def __init__(
+    self,
+    host: str,
+    port: int,
+    uid_cache_size: int = UID_CACHE_SIZE,
+    metadata_cache_ttl: float = METADATA_CACHE_TTL,
+  ):
     """Connects to host:port
     """
-    self.conn = imaplib.IMAP4_SSL(host, port)
+    self.conn = _IMAP4_SSL(host, port)
+    self.host = host
+    self.user = ""
     self.mailbox = "INBOX"
-    self.uid_cache: dict[str, str] = {}
+    self.uid_cache: LRUCache[bytes, str] = LRUCache(uid_cache_size, self._uid_evicted)
+    self.subject_by_uid: dict[str, bytes] = {}
+    self.metadata_cache_ttl = metadata_cache_ttl
+    self.uidvalidity: bytes | None = None
 
   def login(self, user: str, passwd: str):
     """Log in using user and passwd
     """
     self.conn.login(user, passwd)
+    self.user = user
+
+    # imaplib only knows the capabilities announced before authentication,
+    # servers may announce extensions such as SEARCHRES and LITERAL+ after it
+    typ, data = self.conn.capability()
+    if typ == "OK" and data and data[-1]:
+      self.conn.capabilities = tuple(data[-1].decode().upper().split())
 
   def logout(self) -> None:
     """Log out of the server
     """
+    self.save_uid_cache()
     self.conn.logout()
 
   def select(self, mailbox: str) -> None:
@@ -50,81 +219,342 @@ class IMAPConnection:
       raise Exception()
     self.mailbox = mailbox
 
-  def get_message(self, uid: str) -> bytes | None:
-    """Get a message's text by its UID
+    # UIDs are only valid as long as the mailbox's UIDVALIDITY is unchanged
+    self.uidvalidity = self.conn.response("UIDVALIDITY")[1][0]
+    self.load_uid_cache()
+
+  def _uid_cache_path(self) -> str:
+    """Path of the file the UID cache of the selected mailbox is persisted to
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    account = urllib.parse.quote("%s@%s" % (self.user, self.host), safe="@")
+    return os.path.join(cache_home, "imapfs", account, urllib.parse.quote(self.mailbox, safe=""))
+
+  def load_uid_cache(self) -> None:
+    """Load the UIDs cached by a previous mount
+    They are discarded if older than metadata_cache_ttl, or if the mailbox's UIDVALIDITY changed
+    """
+    if not self.metadata_cache_ttl or not self.uidvalidity:
+      return
+
+    path = self._uid_cache_path()
+    if not dbm.whichdb(path):
+      return
+
+    uids = {}
+    try:
+      with dbm.open(path, "r") as db:
+        saved = float(db.get(b"saved", b"0"))
+        if db.get(b"uidvalidity") == self.uidvalidity and time.time() - saved < self.metadata_cache_ttl:
+          for key in db.keys():
+            # Keys are 16 bytes, unlike the entries above
+            if isinstance(key, bytes) and len(key) == 16:
+              uid = db[key].decode("ascii")
+              if not uid.isdigit():
+                raise ValueError("Invalid UID %r" % uid)
+              uids[key] = uid
+      # Changes made from now on make the stored UIDs stale, even if unmounting fails
+      dbm.open(path, "n").close()
+    except (OSError, ValueError, UnicodeError, *dbm.error):
+      # Nothing is loaded from a corrupt file, the next unmount replaces it
+      logging.warning("Cannot load UID cache %s", path, exc_info=True)
+      return
+
+    for key, uid in uids.items():
+      self._cache_uid(key, uid)
+    logging.debug("Loaded %d cached UIDs", len(self.uid_cache))
+
+  def save_uid_cache(self) -> None:
+    """Persist the UID cache, to be loaded by the next mount
+    """
+    if not self.metadata_cache_ttl or not self.uidvalidity:
+      return
+
+    path = self._uid_cache_path()
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with dbm.open(path, "n") as db:
+        for key, uid in self.uid_cache.items():
+          db[key] = uid
+        db[b"uidvalidity"] = self.uidvalidity
+        db[b"saved"] = str(time.time())
+    except (OSError, *dbm.error):
+      logging.warning("Cannot save UID cache %s", path, exc_info=True)
+
+  def get_message_by_subject(self, key: bytes) -> bytes | None:
+    """Get a message's text by its subject key
+    A cached UID that no longer exists is looked up again
     Returns None if not found
     """
-    if not uid:
-      return None
+    return self.get_messages_by_subjects([key]).get(key)
 
-    params = self.conn.uid("FETCH", uid, "(BODY[1])")
-    if not params[1]:
-      # Clear from cache
-      for subject, s_uid in self.uid_cache.items():
-        if s_uid == uid:
-          self.uid_cache.pop(subject)
-      return None
+  def get_messages(self, uids: list[str], size: int | None = None, skip_compressed: bool = False) -> dict[str, bytes]:
+    """Get the text of several messages by their UIDs
+    Fetches up to BATCH_SIZE messages per round trip
+    If size is given, only the first size bytes of each message are fetched,
+    except for compressed messages, which are fetched whole, or left out if
+    skip_compressed is set
+    Messages that are not found are left out of the result
+    """
+    items = "(BODY.PEEK[HEADER.FIELDS (CONTENT-TYPE)] %s)" % _body_item(size)
+
+    results = {}
+    whole = []
+    for i in range(0, len(uids), BATCH_SIZE):
+      batch = uids[i:i + BATCH_SIZE]
+      params = self.conn.uid("FETCH", ",".join(batch), items)
+      fetched = _parse_fetch(params[1])
 
-    data = params[1][0][1]
-    return b64decode(data)
+      for uid in batch:
+        if uid not in fetched:
+          # Clear from cache
+          self._forget_uid(uid)
+          continue
+        data = _decode_body(fetched[uid], size)
+        if data is not None:
+          results[uid] = data
+        elif not skip_compressed:
+          whole.append(uid)
 
-  def put_message(self, subject: str, data: bytes) -> None:
-    """Store a message
-    subject is stored as the message's subject
+    if whole:
+      results.update(self.get_messages(whole))
+
+    return results
+
+  def get_messages_by_subjects(
+    self, keys: list[bytes], size: int | None = None, skip_compressed: bool = False
+  ) -> dict[bytes, bytes]:
+    """Get the text of several messages by subject key
+    size and skip_compressed are used like in get_messages
+    Cached UIDs that no longer exist are looked up again
+    Messages that are not found are left out of the result
     """
+    cached = {key: self.uid_cache[key] for key in keys if key in self.uid_cache}
+    data = self.get_messages(list(cached.values()), size, skip_compressed)
+    results = {key: data[uid] for key, uid in cached.items() if uid in data}
 
-    # Invalidate cache
-    if subject in self.uid_cache:
-      self.uid_cache.pop(subject)
+    # get_messages dropped the UIDs that no longer exist from the cache
+    missing = [key for key in keys if key not in self.uid_cache]
+    if not missing:
+      return results
 
-    msg = email.mime.text.MIMEText(b64encode(data).decode())
-    msg['Subject'] = subject
+    results.update(self._search_and_fetch(missing, size, skip_compressed))
+    return results
 
-    results = self.conn.append(self.mailbox, "(\\Seen \\Draft)", time.time(), msg.as_string().encode())
+  def _search_and_fetch(self, keys: list[bytes], size: int | None, skip_compressed: bool) -> dict[bytes, bytes]:
+    """Look up and fetch messages by subject key, with one SEARCH and one FETCH per BATCH_SIZE keys
+    If the server supports SEARCHRES, the FETCH is pipelined after a SEARCH
+    saving its result, and refers to that result as $
+    """
+    query = "(BODY.PEEK[HEADER.FIELDS (SUBJECT CONTENT-TYPE)] %s)" % _body_item(size)
+    searchres = "SEARCHRES" in self.conn.capabilities
 
-    # Attempt to cache new UID
-    # Requires the server to provide APPENDUID statement
-    info = results[1][0].decode()
-    match = re.search("APPENDUID [0-9]+ ([0-9]+)", info, re.I)
-    if match:
-      new_uid = match.group(1)
-      self.uid_cache[subject] = new_uid
+    results = {}
+    whole = {}
+    for i in range(0, len(keys), BATCH_SIZE):
+      wanted = {format_key(key): key for key in keys[i:i + BATCH_SIZE]}
+      criteria = _subject_criteria(list(wanted))
+
+      if searchres:
+        tag = self.conn._command("UID", "SEARCH", "RETURN", "(SAVE)", *criteria)
+        params = self.conn.uid("FETCH", "$", query)
+        self.conn._command_complete("UID", tag)
+      else:
+        found = self._search(*criteria)
+        if not found:
+          continue
+        # SEARCH does not tell which UID matched which subject, the FETCH does
+        params = self.conn.uid("FETCH", ",".join(found), query)
+
+      fetched = _parse_fetch(params[1])
+      for key, uid in _newest_by_subject(fetched, wanted).items():
+        self._cache_uid(key, uid)
+        data = _decode_body(fetched[uid], size)
+        if data is not None:
+          results[key] = data
+        elif not skip_compressed:
+          whole[uid] = key
+
+    for uid, data in self.get_messages(list(whole)).items():
+      results[whole[uid]] = data
+
+    return results
+
+  def put_messages(self, messages: list[tuple[bytes, bytes, str | None, bool]]) -> None:
+    """Store several messages
+    Each message is given as (key, data, replace_uid, compress)
+    key is stored as the message's subject
+    If replace_uid is given, that message is deleted in the same round trip
+    If compress is set, data is stored compressed when that makes it smaller
+    The commands of up to BATCH_SIZE messages are pipelined
+    Raises IOError if the server refuses to store a message, in which case
+    the message it replaces is kept
+    """
+    for i in range(0, len(messages), BATCH_SIZE):
+      tags = []
+      for key, data, replace_uid, compress in messages[i:i + BATCH_SIZE]:
+        # Invalidate cache
+        self._forget_key(key)
+
+        # The content type tells readers whether to decompress
+        content_type = b"application/octet-stream"
+        packed = compress_message(data) if compress else None
+        if packed is not None and len(packed) < len(data):
+          data = packed
+          content_type = b"application/zstd"
+
+        payload = _MESSAGE_HEADERS % (format_key(key).encode(), content_type) + encode_message(data)
+
+        # Pipeline all commands before waiting for any response
+        tag = self._send_append(payload)
+        delete_tag = self._send_delete(replace_uid) if replace_uid else None
+        tags.append((key, tag, replace_uid, delete_tag))
+
+      failed = []
+      for key, tag, replace_uid, delete_tag in tags:
+        typ, results = self.conn._command_complete("APPEND", tag)
+        if replace_uid and delete_tag:
+          self._complete_delete(replace_uid, delete_tag)
+
+        if typ != "OK":
+          # The pipelined STORE already flagged the old version as deleted
+          if replace_uid:
+            self._undelete(replace_uid)
+          failed.append(key)
+          continue
+
+        # Attempt to cache new UID
+        # Requires the server to provide APPENDUID statement
+        match = _APPENDUID_RE.search(results[0] or b"")
+        if match:
+          self._cache_uid(key, match.group(1).decode())
+
+      if failed:
+        raise IOError("Cannot store messages %s" % ", ".join(format_key(key) for key in failed))
 
   def delete_message(self, uid: str) -> None:
     """Delete a message by UID
     """
-    self.conn.uid("STORE", uid, "+FLAGS", "\\Deleted")
+    self._complete_delete(uid, self._send_delete(uid))
+
+    # self.conn.expunge()
+
+  def _send_append(self, literal: bytes) -> bytes:
+    """Send an APPEND of literal to the mailbox without waiting for its completion
+    literal must already use CRLF line breaks
+    Returns the command tag
+    """
+    flags = "(\\Seen \\Draft)"
+    date_time = imaplib.Time2Internaldate(time.time())
+
+    if "LITERAL+" in self.conn.capabilities:
+      # Non-synchronizing literal, no need to wait for a continuation
+      tag = self.conn._new_tag()
+      command = "APPEND %s %s %s {%d+}" % (self.mailbox, flags, date_time, len(literal))
+      self.conn.send(tag + b" " + command.encode() + b"\r\n" + literal + b"\r\n")
+      return tag
+
+    # imaplib sends bytes literals as they are
+    self.conn.literal = literal  # type: ignore[assignment]
+    return self.conn._command("APPEND", self.mailbox, flags, date_time)
+
+  def _send_delete(self, uid: str) -> bytes:
+    """Send a STORE flagging a message as deleted without waiting for its completion
+    Returns the command tag
+    """
+    return self.conn._command("UID", "STORE", uid, "+FLAGS", "\\Deleted")
+
+  def _complete_delete(self, uid: str, tag: bytes) -> None:
+    """Wait for the STORE sent by _send_delete
+    """
+    typ, data = self.conn._command_complete("UID", tag)
+    # Discard the untagged FETCH responses
+    self.conn._untagged_response(typ, data, "FETCH")
 
     # Invalidate cache
-    for subject, s_uid in list(self.uid_cache.items()):
-        if s_uid == uid:
-          self.uid_cache.pop(subject)
+    self._forget_uid(uid)
 
-    # self.conn.expunge()
+  def _undelete(self, uid: str) -> None:
+    """Clear the deleted flag set by _send_delete
+    """
+    typ, data = self.conn.uid("STORE", uid, "-FLAGS", "\\Deleted")
+    self.conn._untagged_response(typ, data, "FETCH")
 
   def search_by_subject(self, subject: str) -> list[str] | None:
-    """Returns a list of UIDs of messages with given subject
+    """Returns a list of UIDs of messages with given subject, leaving out deleted ones
     """
-    results = self.conn.uid("SEARCH", "SUBJECT", "\"%s\"" % subject)
-    if not results[1]:
-      return None
-    uids = [part.decode() for part in results[1][0].split(b" ")]
-    if len(uids) == 1 and uids[0] == '':
+    uids = self._search(*_subject_criteria([subject]))
+    if not uids:
       return None
 
     return uids
 
-  def get_uid_by_subject(self, subject: str) -> str | None:
-    """Get the UID of a single message with subject subject
+  def _search(self, *criteria: str) -> list[str]:
+    """Returns the UIDs of messages matching criteria
     """
-    # Check cache
-    if subject in self.uid_cache:
-      return self.uid_cache[subject]
+    results = self.conn.uid("SEARCH", *criteria)
+    if not results[1] or not results[1][0]:
+      return []
+    return [part.decode() for part in results[1][0].split(b" ") if part]
 
-    results = self.search_by_subject(subject)
-    if not results:
-      return None
+  def get_uid_by_subject(self, key: bytes) -> str | None:
+    """Get the UID of a single message with subject key
+    Looked up like get_uids_by_subjects, so both agree on which message is found
+    """
+    return self.get_uids_by_subjects([key]).get(key)
+
+  def get_uids_by_subjects(self, keys: list[bytes]) -> dict[bytes, str]:
+    """Get the UIDs of several messages by subject key
+    Keys missing from the cache are looked up with one SEARCH and one
+    FETCH of the subject headers per BATCH_SIZE keys
+    Keys that are not found are left out of the result
+    """
+    uids = {key: self.uid_cache[key] for key in keys if key in self.uid_cache}
+    missing = [key for key in keys if key not in uids]
 
-    self.uid_cache[subject] = results[-1]
+    for i in range(0, len(missing), BATCH_SIZE):
+      wanted = {format_key(key): key for key in missing[i:i + BATCH_SIZE]}
 
-    return results[-1]
+      found = self._search(*_subject_criteria(list(wanted)))
+      if not found:
+        continue
+
+      if len(wanted) == 1:
+        # All found messages have the subject, keep the newest like _newest_by_subject
+        found_uids = {next(iter(wanted.values())): max(found, key=int)}
+      else:
+        # SEARCH does not tell which UID matched which subject
+        params = self.conn.uid("FETCH", ",".join(found), "(BODY.PEEK[HEADER.FIELDS (SUBJECT)])")
+        found_uids = _newest_by_subject(_parse_fetch(params[1]), wanted)
+
+      for key, uid in found_uids.items():
+        uids[key] = uid
+        self._cache_uid(key, uid)
+
+    return uids
+
+  def _cache_uid(self, key: bytes, uid: str) -> None:
+    """Cache the UID of the message with subject key
+    """
+    self._forget_key(key)
+    self.uid_cache[key] = uid
+    self.subject_by_uid[uid] = key
+
+  def _forget_key(self, key: bytes) -> None:
+    """Remove the cached UID of key
+    """
+    uid = self.uid_cache.pop(key, None)
+    if uid is not None:
+      self.subject_by_uid.pop(uid, None)
+
+  def _forget_uid(self, uid: str) -> None:
+    """Remove uid from the cache
+    """
+    key = self.subject_by_uid.pop(uid, None)
+    if key is not None:
+      self.uid_cache.pop(key, None)
+
+  def _uid_evicted(self, key: bytes, uid: str) -> None:
+    """Keep subject_by_uid in sync with evictions from uid_cache
+    """
+    self.subject_by_uid.pop(uid, None)
@@ -0,0 +1,37 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import uuid
+
+
+def new_key() -> bytes:
+  """Generate a random 16 byte key for a new message
+  """
+  return uuid.uuid4().bytes
+
+
+def format_key(key: bytes) -> str:
+  """Format a key as text, as used in message subjects and node listings
+  """
+  return str(uuid.UUID(bytes=key))
+
+
+def parse_key(text: str | bytes) -> bytes:
+  """Parse a key formatted by format_key
+  """
+  if isinstance(text, bytes):
+    text = text.decode()
+  return uuid.UUID(text).bytes
@@ -0,0 +1,53 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Generic, TypeVar
+
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class LRUCache(OrderedDict[K, V], Generic[K, V]):
+  """Dictionary holding at most max_size entries
+  The least recently used entries are evicted first
+  """
+
+  def __init__(self, max_size: int, on_evict: Callable[[K, V], None] | None = None):
+    super().__init__()
+    self.max_size = max_size
+    self.on_evict = on_evict
+
+  def __getitem__(self, key: K) -> V:
+    value = super().__getitem__(key)
+    self.move_to_end(key)
+    return value
+
+  def __setitem__(self, key: K, value: V) -> None:
+    super().__setitem__(key, value)
+    self.move_to_end(key)
+    self.evict()
+
+  def evict(self) -> None:
+    """Evict entries until there are at most max_size
+    on_evict is called with each evicted entry
+    """
+    while len(self) > self.max_size:
+      key, value = self.popitem(last=False)
+      if self.on_evict:
+        self.on_evict(key, value)
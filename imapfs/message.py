@@ -17,22 +17,78 @@
 import logging
 import os
 from typing import Self
-import uuid
 
 from imapfs.imapconnection import IMAPConnection
+from imapfs.keys import new_key
+
+
+# Size of the chunks holding message data in memory
+CHUNK_SIZE = 65536
+
+# Number of bytes fetched by open_meta
+# Enough for the header line of a node, and for most nodes to be fetched whole
+# in the same round trip
+META_SIZE = 4096
+
+# Messages larger than this are stored compressed, if that makes them smaller
+COMPRESS_THRESHOLD = 4096
 
 
 class Message:
   """Represents an IMAP message as a file-like object
+  Data is held in CHUNK_SIZE chunks, so that writes never reallocate all of it
+  The last chunk is only as long as the data, so that small messages stay small
+  If loaded is False, data is only the start of the message and the rest is
+  fetched when it is first needed
   """
 
-  def __init__(self, conn: IMAPConnection, name: str, data: bytes):
+  def __init__(self, conn: IMAPConnection, key: bytes, data: bytes, loaded: bool = True):
     self.conn = conn
-    self.name = name
-    self.data = bytearray(data)
+    self.key = key
+    self.chunks: list[bytearray] = []
+    self.size = 0
     self.dirty = False
     self.pos = 0
     self.compress = False
+    self.loaded = loaded
+
+    self.set_data(data)
+
+  def set_data(self, data: bytes) -> None:
+    """Replace the data held, without marking the message dirty
+    """
+    view = memoryview(data)
+    self.chunks = [bytearray(view[i:i + CHUNK_SIZE]) for i in range(0, len(data), CHUNK_SIZE)]
+    self.size = len(data)
+
+  def load(self) -> None:
+    """Fetch the whole message, if only its start was fetched by open_meta
+    Raises IOError if not found
+    """
+    if self.loaded:
+      return
+
+    logging.debug("Loading message %s", self.key.hex())
+    data = self.conn.get_message_by_subject(self.key)
+    if data is None:
+      raise IOError()
+
+    self.set_data(data)
+    self.loaded = True
+
+  @property
+  def header(self) -> bytes:
+    """First 3 bytes of the message, the type line of a node message
+    """
+    if not self.chunks:
+      return b""
+    return bytes(self.chunks[0][:min(3, self.size)])
+
+  @property
+  def type_code(self) -> bytes:
+    """Type code of a node message, b"f" or b"d"
+    """
+    return self.header[:1]
 
   def seek(self, off, whence=os.SEEK_SET):
     """Seek in the message
@@ -42,69 +98,98 @@ class Message:
     elif whence == os.SEEK_CUR:
       self.pos += off
     elif whence == os.SEEK_END:
-      self.pos = len(self.data) - off
+      # size only covers the data held until the message is loaded
+      self.load()
+      self.pos = self.size + off
+    assert self.pos >= 0
 
   def read(self, size=None):
     """Read from the message
+    Returns a memoryview of the data when it lies in a single chunk, which is
+    only valid until the next write
+    Reading past the data held loads the message
     """
-    if size is None:
-      buf = self.data[self.pos:]
-      self.pos += len(buf)
-      return buf
-    else:
-      if size + self.pos > len(self.data):
-        size = len(self.data) - self.pos
+    if size is None or self.pos + size > self.size:
+      self.load()
+
+    end = self.size
+    if size is not None and self.pos + size < end:
+      end = self.pos + size
 
-      buf = self.data[self.pos:self.pos + size]
-      self.pos += size
-      return buf
+    parts = []
+    pos = self.pos
+    while pos < end:
+      chunk_id, off = divmod(pos, CHUNK_SIZE)
+      count = min(CHUNK_SIZE - off, end - pos)
+      parts.append(memoryview(self.chunks[chunk_id])[off:off + count])
+      pos += count
+
+    self.pos = pos
+    if len(parts) == 1:
+      return parts[0]
+    return b"".join(parts)
 
   def truncate(self, size=None):
     """Resize the message
+    Growing fills the new bytes with zeros
     """
     if size is None:
       return
 
-    if len(self.data) > size:
-      self.data = self.data[:size]
+    if size > 0:
+      self.load()
+    else:
+      # Nothing of the old data is kept, no need to fetch it
+      self.loaded = True
+
+    if self.size > size:
+      chunk_count = -(-size // CHUNK_SIZE)
+      del self.chunks[chunk_count:]
+      if self.chunks:
+        del self.chunks[-1][size - (chunk_count - 1) * CHUNK_SIZE:]
+
       if self.pos > size:
         self.pos = size
-    else:
-      self.data += b"." * (size - len(self.data))
+    elif self.size < size:
+      # Fill the last chunk, then add chunks, the new last one sized to the end
+      if self.chunks:
+        last = self.chunks[-1]
+        last.extend(bytes(min(CHUNK_SIZE, len(last) + size - self.size) - len(last)))
+      while len(self.chunks) * CHUNK_SIZE < size:
+        self.chunks.append(bytearray(min(CHUNK_SIZE, size - len(self.chunks) * CHUNK_SIZE)))
 
+    self.size = size
     self.dirty = True
 
-  def write(self, buf: bytes):
+  def write(self, buf: bytes | memoryview):
     """Write to the message
     """
-    if self.pos + len(buf) > len(self.data):
+    self.load()
+    if self.pos + len(buf) > self.size:
       # Resize to fit
       self.truncate(self.pos + len(buf))
 
-    self.data[self.pos:self.pos + len(buf)] = buf
-    self.pos += len(buf)
+    view = memoryview(buf)
+    done = 0
+    while done < len(view):
+      chunk_id, off = divmod(self.pos, CHUNK_SIZE)
+      count = min(CHUNK_SIZE - off, len(view) - done)
+      self.chunks[chunk_id][off:off + count] = view[done:done + count]
+      self.pos += count
+      done += count
+
     self.dirty = True
 
+  def getvalue(self) -> bytes:
+    """Returns the whole data of the message
+    """
+    self.load()
+    return b"".join(self.chunks)
+
   def flush(self):
     """Write any changes to the server
     """
-    if self.dirty:
-      logging.debug("Flushing %d bytes", len(self.data))
-
-      # Find old uid
-      old_uid = self.conn.get_uid_by_subject(self.name)
-
-      # Store message
-      # Compress, if requested
-      data_str = bytes(self.data)
-
-      self.conn.put_message(self.name, data_str)
-
-      # Delete old version
-      if old_uid:
-        self.conn.delete_message(old_uid)
-
-      self.dirty = False
+    Message.flush_many(self.conn, [self])
 
   def close(self):
     """Close the message. Writes any changes.
@@ -113,34 +198,89 @@ class Message:
 
   @classmethod
   def create(cls, conn: IMAPConnection) -> Self:
-    msg = cls(conn, str(uuid.uuid4()), b"")
+    msg = cls(conn, new_key(), b"")
     msg.dirty = True
     return msg
 
   @classmethod
-  def open(cls, conn: IMAPConnection, name: str) -> Self:
-    """Open a message with name `name'
+  def open(cls, conn: IMAPConnection, key: bytes) -> Self:
+    """Open a message with key `key'
     Raises IOError if not found
     """
-    # Find message with subject 'name'
-    uid = conn.get_uid_by_subject(name)
-    if not uid:
-      raise IOError()
-
-    data = conn.get_message(uid)
+    # Find message with subject 'key'
+    data = conn.get_message_by_subject(key)
     if data is None:
       raise IOError()
 
-    msg = cls(conn, name, data)
+    msg = cls(conn, key, data)
+
+    return msg
+
+  @classmethod
+  def open_meta(cls, conn: IMAPConnection, key: bytes) -> Self:
+    """Open a message with key `key', fetching only its first META_SIZE bytes
+    The rest is loaded when first needed
+    Raises IOError if not found
+    """
+    msg = cls.open_many(conn, [key], META_SIZE).get(key)
+    if msg is None:
+      raise IOError()
 
     return msg
 
+  @classmethod
+  def open_many(
+    cls, conn: IMAPConnection, keys: list[bytes], size: int | None = None, skip_compressed: bool = False
+  ) -> dict[bytes, Self]:
+    """Open several messages by key, using batched lookups
+    If size is given, only the first size bytes of each message are fetched,
+    and the rest is loaded when first needed
+    If skip_compressed is set, compressed messages longer than size are left
+    out instead of being fetched whole
+    Messages that are not found are left out of the result
+    """
+    messages = {}
+    for key, data in conn.get_messages_by_subjects(keys, size, skip_compressed).items():
+      # Partial data is exactly size bytes, anything else is the whole message
+      loaded = size is None or len(data) != size
+      if not loaded and data.count(b"\r\n") < 2:
+        # Header line longer than size
+        data = conn.get_message_by_subject(key) or b""
+        loaded = True
+      messages[key] = cls(conn, key, data, loaded)
+
+    return messages
+
+  @staticmethod
+  def flush_many(conn: IMAPConnection, messages: list["Message"]) -> None:
+    """Write the changes of several messages to the server
+    Commands are pipelined, old versions are deleted in the same round trips
+    Raises IOError if a message cannot be stored, leaving the messages dirty
+    """
+    dirty = [msg for msg in messages if msg.dirty]
+    if not dirty:
+      return
+
+    logging.debug("Flushing %d messages, %d bytes", len(dirty), sum(msg.size for msg in dirty))
+
+    # Find old uids
+    old_uids = conn.get_uids_by_subjects([msg.key for msg in dirty])
+
+    # Store messages
+    # Compress, if requested, or if large enough to be worth it
+    conn.put_messages(
+      [(msg.key, msg.getvalue(), old_uids.get(msg.key), msg.compress or msg.size > COMPRESS_THRESHOLD) for msg in dirty]
+    )
+
+    for msg in dirty:
+      msg.dirty = False
+
   @staticmethod
-  def unlink(conn, name: str) -> None:
-    """Delete a message with name `name'
+  def unlink(conn, key: bytes) -> None:
+    """Delete a message with key `key'
     """
 
-    uid = conn.get_uid_by_subject(name)
+    uid = conn.get_uid_by_subject(key)
     if not uid:
       return
 